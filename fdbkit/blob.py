@@ -1,50 +1,169 @@
 import fdb
-import math
+import fdb.tuple
+import io
+import itertools
 import os
-from io import BytesIO
+import struct
+from collections import OrderedDict, namedtuple
 
 
 DEFAULT_CHUNK_SIZE = 1024*10
 
+# larger chunks mean fewer keys per blob and fewer operations for big reads and writes,
+# smaller chunks transfer less data for small reads and partial chunk rewrites.
+# foundationdb does not allow values above 100KB.
+CHUNK_SIZE_PRESETS = {
+    'latency': 1024*4,
+    'throughput': 1024*64,
+}
+
+# number of chunks kept in memory by each reader
+DEFAULT_CACHE_SIZE = 64
+
+# number of blob subspaces kept in memory by each manager
+SUBSPACE_CACHE_SIZE = 1024
+
+# reads spanning more chunks than this are split into concurrent range requests
+PARALLEL_READ_THRESHOLD = 16
+PARALLEL_READ_SPLITS = 4
+
+
+# reads issued by BlobReader._start_read and not consumed yet
+_PendingRead = namedtuple('_PendingRead', 'cursor size chunk_size blob_size start_chunk cached ranges')
+
+# a write and the reads it depends on, issued by BlobWriter._start_write
+_PendingWrite = namedtuple('_PendingWrite', 'cursor buf chunk_size blob_size head tail')
+
 
 class BlobManager(object):
     def __init__(self, db, directory=None, chunk_size=DEFAULT_CHUNK_SIZE):
         self._db = db
         self._space = fdb.directory.create_or_open(db, directory or ('blobs',))
+        if not isinstance(chunk_size, int):
+            if chunk_size not in CHUNK_SIZE_PRESETS:
+                raise ValueError('Unknown chunk size %r' % (chunk_size,))
+            chunk_size = CHUNK_SIZE_PRESETS[chunk_size]
+
         self._chunk_size = chunk_size
+        self._subspaces = OrderedDict()
+
+    def _get_space(self, key):
+        # keep recently used subspaces so readers and writers do not rebuild them
+        subspaces = self._subspaces
+        space = subspaces.get(key)
+        if space is None:
+            subspaces[key] = space = self._space[key]
+            if len(subspaces) > SUBSPACE_CACHE_SIZE:
+                subspaces.popitem(last=False)
+        else:
+            subspaces.move_to_end(key)
+
+        return space
 
-    def get_reader(self, key):
-        return BlobReader(self._db, self._space[key], self._chunk_size)
+    def get_reader(self, key, cache_size=DEFAULT_CACHE_SIZE):
+        return BlobReader(self._db, self._get_space(key), self._chunk_size, cache_size)
 
     def get_writer(self, key):
-        return BlobWriter(self._db, self._space[key], self._chunk_size)
+        return BlobWriter(self._db, self._get_space(key), self._chunk_size)
 
     def read(self, key):
-        with self.get_reader(key) as reader:
+        # the reader is thrown away right after, caching its chunks is wasted work
+        with self.get_reader(key, cache_size=0) as reader:
             return reader.read()
 
+    def read_many(self, keys):
+        """
+        Read several blobs in a single transaction, blobs are returned in the order of keys
+        """
+        return self._read_many(self._db, list(keys))
+
+    @fdb.transactional
+    def _read_many(self, tr, keys):
+        # issue the reads of every blob before consuming any of them so they are fetched concurrently
+        reads = []
+        for key in keys:
+            reader = self.get_reader(key, cache_size=0)
+            reads.append((reader, reader._start_read(tr, 0, None, eager=True)))
+
+        blobs = []
+        for reader, read in reads:
+            buf = bytearray()
+            reader._finish_read(tr, read, buf)
+            blobs.append(bytes(buf))
+
+        return blobs
+
     def write(self, key, data):
         with self.get_writer(key) as writer:
             return writer.write(data)
 
+    def write_many(self, items):
+        """
+        Write several blobs in a single transaction, items is a dict or a list of (key, data)
+        """
+        if isinstance(items, dict):
+            items = items.items()
+
+        self._write_many(self._db, list(items))
+
+    @fdb.transactional
+    def _write_many(self, tr, items):
+        # issue the reads of every blob before applying any write so they are fetched concurrently
+        writes = OrderedDict()
+        for key, data in items:
+            if key in writes:
+                # a blob written twice has to read back its first write
+                self._finish_writes(tr, writes)
+
+            writer = self.get_writer(key)
+            writes[key] = (writer, writer._start_write(tr, 0, data))
+
+        self._finish_writes(tr, writes)
+
+    def _finish_writes(self, tr, writes):
+        for writer, write in writes.values():
+            writer._finish_write(tr, write)
+
+        writes.clear()
+
     def delete(self, key):
         self._delete(self._db, key)
 
+    def delete_many(self, keys):
+        """
+        Delete several blobs in a single transaction
+        """
+        self._delete_many(self._db, list(keys))
+
     @fdb.transactional
     def _delete(self, tr, key):
-        space = self._space[key]
-        del tr[space.range()]
+        prefix = self._get_space(key).key()
+        tr.clear_range(prefix + b'\x00', prefix + b'\xff')
+
+    @fdb.transactional
+    def _delete_many(self, tr, keys):
+        for key in keys:
+            self._delete(tr, key)
 
     def exists(self, key):
-        r = self._space[key].range()
-        return len(self._db.get_range(r.start, r.stop, limit=1, reverse=True)) > 0
+        return self._exists(self._db, key)
+
+    @fdb.transactional
+    def _exists(self, tr, key):
+        # only resolve the first key of the blob, no value is transferred
+        r = self._get_space(key).range()
+        return tr.get_key(fdb.KeySelector.first_greater_or_equal(r.start)) < r.stop
 
 
-class BlobIO(object):
+class BlobIO(io.RawIOBase):
     def __init__(self, db, space, chunk_size):
         self._db = db
         self._space = space
+        self._prefix = space.key()
         self._chunk_size = chunk_size
+        self._size_key = self._prefix + fdb.tuple.pack(('size',))
+        self._chunk_size_key = self._prefix + fdb.tuple.pack(('chunk_size',))
+        self._chunk_size_stored = False
         self._cursor = 0
         self._closed = False
 
@@ -67,18 +186,25 @@ class BlobIO(object):
         """
         return self._closed
 
+    def seekable(self):
+        return True
+
     def seek(self, cursor, whence=0):
         """
-        Change current cursor
+        Change current cursor and return it
         """
         if self._closed:
             raise IOError('Can not access closed blob')
 
         self._cursor = self._seek(self._db, self._cursor, cursor, whence)
+        return self._cursor
 
     @fdb.transactional
     def _seek(self, tr, current, cursor, whence):
-        l = self._get_size(tr)
+        chunk_size = self._read_chunk_size(tr)
+        size = tr[self._size_key]
+        self._apply_chunk_size(chunk_size)
+        l = self._unpack_size(tr, size)
 
         if whence == os.SEEK_SET:
             new_cursor = cursor
@@ -91,12 +217,38 @@ class BlobIO(object):
 
         return min(max(new_cursor, 0), l)
 
+    def _read_chunk_size(self, tr):
+        """
+        Start reading the chunk size stored with the blob, return None if it is already known
+        """
+        if not self._chunk_size_stored:
+            return tr[self._chunk_size_key]
+
+    def _apply_chunk_size(self, chunk_size):
+        """
+        Switch to the chunk size read by _read_chunk_size, return False if the blob has none yet
+        """
+        if chunk_size is not None and chunk_size.present():
+            self._chunk_size = struct.unpack('<I', chunk_size.value)[0]
+            self._chunk_size_stored = True
+
+        return self._chunk_size_stored
+
+    def _unpack_size(self, tr, size):
+        """
+        Return the blob size from a read of the size key
+        """
+        if size.present():
+            return struct.unpack('<Q', size.value)[0]
+
+        return self._scan_size(tr)
+
     @fdb.transactional
-    def _get_size(self, tr):
-        # query the last chunk
+    def _scan_size(self, tr):
+        # blobs written before the size key existed, query the last chunk
         r = self._space.range()
         l = 0
-        for k, v in (tr.get_range(r.start, r.stop, 1, True)):
+        for k, v in (tr.get_range(self._space.pack((0,)), r.stop, 1, True)):
             last_chunk_index = self._space.unpack(k)[-1]
             last_chunk_cursor = last_chunk_index * self._chunk_size
 
@@ -114,57 +266,209 @@ class BlobIO(object):
 
 class BlobReader(BlobIO):
     """
-    Seekable blob reader
+    Seekable blob reader, recently read full chunks are cached and dropped when the
+    blob size changes, so the blob is expected not to be rewritten in place while
+    the reader is open. Wrap it in io.BufferedReader to serve small reads from larger
+    chunk aligned ones.
     """
 
+    def __init__(self, db, space, chunk_size, cache_size=DEFAULT_CACHE_SIZE):
+        super(BlobReader, self).__init__(db, space, chunk_size)
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        # the size key as of the cached chunks
+        self._cache_blob_size = None
+
+    def readable(self):
+        return True
+
     def read(self, size=None):
         if self._closed:
             raise IOError('Can not access closed blob')
 
-        buf, cursor = self._read_chunk(self._db, self._cursor, size)
+        if size is not None and size < 0:
+            size = None
+
+        if size == 0:
+            return b''
+
+        # bounded reads fill a preallocated buffer in place
+        buf = bytearray(size or 0)
+        cursor = self._read_chunk(self._db, self._cursor, size, buf)
+
+        # drop the unused tail when the blob is shorter than requested
+        del buf[cursor - self._cursor:]
         self._cursor = cursor
-        return buf.getvalue()
+
+        return bytes(buf)
+
+    def readinto(self, b):
+        """
+        Read directly into a writable buffer and return the number of bytes read
+        """
+        if self._closed:
+            raise IOError('Can not access closed blob')
+
+        out = memoryview(b).cast('B')
+        if not len(out):
+            return 0
+
+        cursor = self._read_chunk(self._db, self._cursor, len(out), out)
+        size = cursor - self._cursor
+        self._cursor = cursor
+
+        return size
 
     @fdb.transactional
-    def _read_chunk(self, tr, cursor, size):
-        start_chunk = cursor / self._chunk_size
-        start_key = self._space.pack((start_chunk,))
+    def _read_chunk(self, tr, cursor, size, out):
+        return self._finish_read(tr, self._start_read(tr, cursor, size), out)
+
+    def _start_read(self, tr, cursor, size, eager=False):
+        """
+        Issue the reads of size bytes at cursor without waiting for them, the result goes to
+        _finish_read. Unbounded reads are streamed unless eager is set.
+        """
+        # an unbounded read from the start does not depend on the chunk size,
+        # the chunk size read stays in flight together with the range reads
+        chunk_size = self._read_chunk_size(tr)
+        if cursor or size:
+            self._apply_chunk_size(chunk_size)
+
+        # build chunk keys from the raw prefix, it is cheaper than Subspace.pack
+        prefix = self._prefix
+        start_chunk = cursor // self._chunk_size
 
         if size:
-            # foundationdb returns the range *exclusive* to the end
-            end_chunk = (cursor + size) / self._chunk_size
-            end_key = fdb.KeySelector.first_greater_than(self._space.pack((end_chunk,)))
-        else:
-            # end_key = self._space.key() + b'\xff'
-            end_key = self._space.range().stop
+            end_chunk = (cursor + size) // self._chunk_size
+
+        # serve the leading chunks from the cache and only fetch the rest
+        cache = self._cache
+        cached = []
+        while start_chunk in cache and (not size or start_chunk <= end_chunk):
+            cache.move_to_end(start_chunk)
+            cached.append((start_chunk, cache[start_chunk]))
+            start_chunk += 1
+
+        ranges = []
+
+        if not size or start_chunk <= end_chunk:
+            start_key = prefix + fdb.tuple.pack((start_chunk,))
+
+            if size:
+                # foundationdb returns the range *exclusive* to the end
+                end_key = fdb.KeySelector.first_greater_than(prefix + fdb.tuple.pack((end_chunk,)))
+            else:
+                end_key = prefix + b'\xff'
+
+            # large bounded reads are split into sub-ranges, every get_range fires its
+            # request right away so the sub-ranges are fetched concurrently
+            if size and end_chunk - start_chunk + 1 > PARALLEL_READ_THRESHOLD:
+                step = (end_chunk - start_chunk + PARALLEL_READ_SPLITS) // PARALLEL_READ_SPLITS
+                for split_chunk in range(start_chunk + step, end_chunk + 1, step):
+                    split_key = prefix + fdb.tuple.pack((split_chunk,))
+                    ranges.append(tr.get_range(start_key, split_key, streaming_mode=fdb.StreamingMode.want_all))
+                    start_key = split_key
+
+            # bounded reads are consumed entirely, let the client fetch them eagerly
+            if size or eager:
+                mode = fdb.StreamingMode.want_all
+            else:
+                mode = fdb.StreamingMode.iterator
 
-        buf = BytesIO()
+            ranges.append(tr.get_range(start_key, end_key, streaming_mode=mode))
 
-        for k, v in tr.get_range(start_key, end_key):
-            chunk_index = self._space.unpack(k)[0]
-            # print chunk_index, ":".join("{:02x}".format(ord(c)) for c in k)
+        blob_size = tr[self._size_key]
 
+        return _PendingRead(cursor, size, chunk_size, blob_size, start_chunk, cached, ranges)
+
+    def _finish_read(self, tr, read, out):
+        """
+        Copy the chunks of a read started by _start_read into out and return the new cursor
+        """
+        cursor = read.cursor
+        start_chunk = read.start_chunk
+        cached = read.cached
+        ranges = read.ranges
+        blob_size = read.blob_size
+
+        prefix = self._prefix
+        cache = self._cache
+
+        # the blob changed since the chunks were cached, read them again
+        if blob_size.value != self._cache_blob_size:
+            cache.clear()
+            if cached:
+                start_chunk = cached[0][0]
+                ranges.insert(0, tr.get_range(
+                    prefix + fdb.tuple.pack((start_chunk,)),
+                    prefix + fdb.tuple.pack((start_chunk + len(cached),)),
+                    streaming_mode=fdb.StreamingMode.want_all,
+                ))
+                cached = []
+
+            self._cache_blob_size = blob_size.value
+
+        self._apply_chunk_size(read.chunk_size)
+        end_cursor = cursor + read.size if read.size else None
+
+        # chunks can be missing from a blob, they read as zeros up to the stored size,
+        # and nothing is read past it. older blobs without a size key have no missing chunks.
+        if blob_size.present():
+            blob_end = max(struct.unpack('<Q', blob_size.value)[0], cursor)
+            end_cursor = blob_end if end_cursor is None else min(end_cursor, blob_end)
+
+        offset = 0
+
+        for chunk_index, v in itertools.chain(cached, self._fetch_chunks(ranges, start_chunk)):
             start_cursor = chunk_index * self._chunk_size
 
-            if cursor >= start_cursor:
-                chunk = v[cursor - start_cursor:]
-                chunk_size = len(chunk)
+            if end_cursor is not None and start_cursor >= end_cursor:
+                break
+
+            if start_cursor > cursor:
+                n = start_cursor - cursor
+                out[offset:offset + n] = bytes(n)
+                offset += n
+                cursor = start_cursor
+
+            chunk = memoryview(v)[cursor - start_cursor:]
+            if end_cursor is not None:
+                chunk = chunk[:end_cursor - cursor]
+
+            out[offset:offset + len(chunk)] = chunk
+            offset += len(chunk)
+            cursor += len(chunk)
 
-                if size:
-                    if size < chunk_size:
-                        chunk = chunk[:size]
-                        chunk_size = size
-                    else:
-                        size -= chunk_size
+            if cursor == end_cursor:
+                break
 
-                cursor += chunk_size
-                buf.write(chunk)
+        if end_cursor is not None and blob_size.present() and end_cursor > cursor:
+            n = end_cursor - cursor
+            out[offset:offset + n] = bytes(n)
+            cursor = end_cursor
 
-                # special case when we are just at the boundary of the chunk
-                if size == 0:
-                    break
+        return cursor
 
-        return buf, cursor
+    def _fetch_chunks(self, ranges, chunk_index):
+        cache = self._cache
+        prefix = self._prefix
+        pack = fdb.tuple.pack
+
+        # chunks are usually contiguous so the index follows from the previous one,
+        # comparing keys is cheaper than unpacking them. a blob can still miss chunks
+        # after a delete under a live writer, those keys are unpacked.
+        for k, v in itertools.chain(*ranges):
+            if k != prefix + pack((chunk_index,)):
+                chunk_index = self._space.unpack(k)[0]
+
+            # a short chunk is the end of the blob and changes with the next append
+            if self._cache_size and len(v) == self._chunk_size:
+                cache[chunk_index] = v
+                while len(cache) > self._cache_size:
+                    cache.popitem(last=False)
+
+            yield chunk_index, v
+            chunk_index += 1
 
 
 class BlobWriter(BlobIO):
@@ -172,53 +476,143 @@ class BlobWriter(BlobIO):
     Seekable blob writer
     """
 
+    def writable(self):
+        return True
+
     def write(self, data):
+        """
+        Write data at the current cursor and return the number of bytes written
+        """
         if self._closed:
             raise IOError('Can not access closed blob')
 
         # this is not thread-safe
-        self._cursor = self._write(self._db, self._cursor, data)
+        cursor = self._write(self._db, self._cursor, data)
+        self._chunk_size_stored = True
+        size = cursor - self._cursor
+        self._cursor = cursor
+
+        return size
+
+    def write_batch(self, buffers):
+        """
+        Write a sequence of buffers in a single transaction
+        """
+        return self.write(b''.join(buffers))
+
+    def _read_ends(self, tr, cursor, end_cursor):
+        """
+        Start reading the partial chunks at both ends of a write, None where no chunk is needed
+        """
+        chunk_size = self._chunk_size
+        head = tail = None
+
+        if cursor % chunk_size:
+            head = tr[self._prefix + fdb.tuple.pack((cursor // chunk_size,))]
+
+        if end_cursor % chunk_size and not (head is not None and end_cursor // chunk_size == cursor // chunk_size):
+            tail = tr[self._prefix + fdb.tuple.pack((end_cursor // chunk_size,))]
+
+        return head, tail
 
     @fdb.transactional
     def _write(self, tr, cursor, data):
-        buf = buffer(data)
+        """
+        Write data at cursor and return the new cursor
+        """
+        return self._finish_write(tr, self._start_write(tr, cursor, data))
+
+    def _start_write(self, tr, cursor, data):
+        """
+        Issue the reads a write depends on without waiting for them, the result goes to _finish_write
+        """
+        buf = memoryview(data).cast('B')
+
+        # the chunk reads are issued with the configured chunk size together with the read
+        # of the stored one, so they are all in flight at once. they are issued again in
+        # the rare case the blob was created with another chunk size.
+        stored_chunk_size = self._read_chunk_size(tr)
+
+        head, tail = self._read_ends(tr, cursor, cursor + len(buf))
+        stored_size = tr[self._size_key]
+
+        return _PendingWrite(cursor, buf, stored_chunk_size, stored_size, head, tail)
+
+    def _finish_write(self, tr, write):
+        """
+        Apply a write started by _start_write and return the new cursor
+        """
+        cursor = write.cursor
+        buf = write.buf
+        stored_chunk_size = write.chunk_size
+        stored_size = write.blob_size
+        head = write.head
+        tail = write.tail
+
+        end_cursor = cursor + len(buf)
+        configured_chunk_size = self._chunk_size
+        size_stored = stored_size.present()
+
+        # a blob deleted under this writer lost its chunk size key too, do not trust the flag
+        if not size_stored and stored_chunk_size is None:
+            self._chunk_size_stored = False
+            stored_chunk_size = tr[self._chunk_size_key]
+
+        # blobs keep the chunk size they were first written with
+        if not self._apply_chunk_size(stored_chunk_size):
+            tr[self._chunk_size_key] = struct.pack('<I', self._chunk_size)
+        elif self._chunk_size != configured_chunk_size:
+            head, tail = self._read_ends(tr, cursor, end_cursor)
+
+        size = self._unpack_size(tr, stored_size)
+
         chunk_size = self._chunk_size
+        chunk_index = cursor // chunk_size
+        prefix = self._prefix
 
-        chunks = int(math.ceil(float(len(buf)) / chunk_size))
-        chunk_index = cursor / chunk_size
-        start_cursor = chunk_index * chunk_size
+        offset = cursor % chunk_size
+        tail_index = end_cursor // chunk_size
+        tail_offset = end_cursor % chunk_size
 
-        # write the first partial chunk
-        if start_cursor != cursor:
-            next_cursor = start_cursor + chunk_size
-            chunk = tr[self._space.pack((chunk_index,))]
+        head_key = prefix + fdb.tuple.pack((chunk_index,))
+        tail_key = prefix + fdb.tuple.pack((tail_index,))
 
-            assert chunk.present(), 'Do not support missing chunk yet'
+        # missing chunks read as zeros
+        if head is not None:
+            head = head.value or b''
 
-            # TODO: we may cache this current chunk to avoid repeat reading
-            new_chunk = chunk[0:cursor - start_cursor] + buf[0:next_cursor - cursor]
-            tr[self._space.pack((chunk_index,))] = new_chunk
+        if tail is not None:
+            tail = tail.value or b''
 
-            buf = buffer(data, next_cursor - cursor)
+        # rewrite the first partial chunk, then fall through to the aligned chunks
+        if offset:
+            n = min(len(buf), chunk_size - offset)
+            last_chunk = bytearray(max(len(head), offset))
+            last_chunk[0:len(head)] = head
+            last_chunk[offset:offset + n] = buf[0:n]
+            tr[head_key] = bytes(last_chunk)
 
-            # advance the cursor
-            if len(new_chunk) == chunk_size:
-                cursor = next_cursor
-            else:
-                cursor = start_cursor + len(new_chunk)
+            buf = buf[n:]
+            cursor += n
+            chunk_index += 1
 
-            if len(buf) == 0:
-                return cursor
+        chunks = len(buf) // chunk_size
 
-            return self._write(tr, cursor, buf)
+        # hoist lookups out of the loop, this is the hot path for large writes
+        pack = fdb.tuple.pack
+        set_chunk = tr.set
 
         for i in range(chunks):
-            chunk = data[i * chunk_size:(i+1) * chunk_size]
-            this_chunk_size = len(chunk)
-            assert this_chunk_size <= chunk_size
+            set_chunk(prefix + pack((chunk_index + i,)), buf[i * chunk_size:(i + 1) * chunk_size].tobytes())
 
-            tr[self._space.pack((chunk_index,))] = chunk
-            cursor += len(chunk)
-            chunk_index += 1
+        # keep the bytes already stored past the end of the write
+        if len(buf) > chunks * chunk_size:
+            last_chunk = bytearray(tail or b'')
+            last_chunk[0:tail_offset] = buf[chunks * chunk_size:]
+            tr[tail_key] = bytes(last_chunk)
 
-        return cursor
+        # a missing size key is filled in so older blobs stop needing the scan
+        if end_cursor > size or not size_stored:
+            tr[self._size_key] = struct.pack('<Q', max(end_cursor, size))
+
+        return end_cursor
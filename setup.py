@@ -1,4 +1,4 @@
-from distutils.core import setup
+from setuptools import setup
 
 setup(
     name='fdbkit',
@@ -8,4 +8,5 @@ setup(
     author_email='b@nqbao.com',
     url='http://nqbao.com',
     packages=['fdbkit'],
+    python_requires='>=3.4',
 )
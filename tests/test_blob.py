@@ -1,3 +1,4 @@
+import io
 from unittest import TestCase
 from fdbkit.blob import BlobWriter, BlobReader, BlobManager
 import fdb
@@ -23,107 +24,271 @@ class BlobTestCase(TestCase):
 
     def test_manager(self):
         manager = BlobManager(self.db, ('blob-test',), 4)
-        with manager.get_writer('test') as writer:
-            writer.write('hello world')
+        with manager.get_writer(b'test') as writer:
+            writer.write(b'hello world')
 
-        with manager.get_reader('test') as reader:
-            self.assertEquals('hello world', reader.read())
+        with manager.get_reader(b'test') as reader:
+            self.assertEqual(b'hello world', reader.read())
 
-        manager.write('test2', '12345')
-        self.assertEquals(manager.read('test2'), '12345')
+        manager.write(b'test2', b'12345')
+        self.assertEqual(manager.read(b'test2'), b'12345')
+
+    def test_write_many(self):
+        manager = BlobManager(self.db, ('blob-test',), 4)
+        manager.write_many([(b'test', b'hello world'), (b'test2', b'12345')])
+
+        self.assertEqual(manager.read(b'test'), b'hello world')
+        self.assertEqual(manager.read(b'test2'), b'12345')
+
+        # a blob written twice sees its first write
+        manager.write_many([(b'test3', b'hello world'), (b'test3', b'HELLO')])
+        self.assertEqual(manager.read(b'test3'), b'HELLO world')
+
+    def test_read_many(self):
+        manager = BlobManager(self.db, ('blob-test',), 4)
+        manager.write(b'test', b'hello world')
+        manager.write(b'test2', b'12345')
+
+        self.assertEqual(manager.read_many([b'test2', b'missing', b'test']), [b'12345', b'', b'hello world'])
+
+        # missing chunks read as zeros like with a reader
+        writer = manager.get_writer(b'test3')
+        writer.write(b'abcdef')
+        manager.delete(b'test3')
+        writer.write(b'gh')
+
+        self.assertEqual(manager.read_many([b'test3']), [b'\x00\x00\x00\x00\x00\x00gh'])
+
+    def test_chunk_size(self):
+        manager = BlobManager(self.db, ('blob-test',), 4)
+        manager.write(b'test', b'hello world')
+
+        # the chunk size stored with the blob wins over the configured one
+        other = BlobManager(self.db, ('blob-test',), 'latency')
+        self.assertEqual(other.read(b'test'), b'hello world')
+
+        with other.get_writer(b'test') as writer:
+            writer.seek(6)
+            writer.write(b'there')
+
+        self.assertEqual(manager.read(b'test'), b'hello there')
+
+        with self.assertRaises(ValueError):
+            BlobManager(self.db, ('blob-test',), 'fastest')
 
     def test_delete(self):
         manager = BlobManager(self.db, ('blob-test',), 4)
-        self.assertFalse(manager.exists('test'))
-        manager.write('test', '1111')
-        self.assertTrue(manager.exists('test'))
-        manager.delete('test')
-        self.assertFalse(manager.exists('test'))
+        self.assertFalse(manager.exists(b'test'))
+        manager.write(b'test', b'1111')
+        self.assertTrue(manager.exists(b'test'))
+        manager.delete(b'test')
+        self.assertFalse(manager.exists(b'test'))
+
+    def test_delete_many(self):
+        manager = BlobManager(self.db, ('blob-test',), 4)
+        manager.write_many({b'test': b'1111', b'test2': b'2222', b'test3': b'3333'})
+        manager.delete_many([b'test', b'test3'])
+
+        self.assertFalse(manager.exists(b'test'))
+        self.assertTrue(manager.exists(b'test2'))
+        self.assertFalse(manager.exists(b'test3'))
 
     def test_blob_writer(self):
         writer = BlobWriter(self.db, self.directory, 4)
-        writer.write('abcd')
-        writer.write('efg')
+        writer.write(b'abcd')
+        writer.write(b'efg')
 
         self.assertEqual(7, writer.tell())
 
-        self.assertEquals('abcdefg', self._read_all())
+        self.assertEqual(b'abcdefg', self._read_all())
+
+    def test_write_batch(self):
+        writer = BlobWriter(self.db, self.directory, 4)
+        writer.write(b'ab')
+        writer.write_batch([b'cd', b'efg', b'h'])
+
+        self.assertEqual(8, writer.tell())
+        self.assertEqual(b'abcdefgh', self._read_all())
+
+    def test_append_write(self):
+        writer = BlobWriter(self.db, self.directory, 4)
+        writer.write(b'abcdef')
+
+        # writes made by another writer between two appends are kept
+        other = BlobWriter(self.db, self.directory, 4)
+        other.seek(4)
+        other.write(b'EF')
+        writer.write(b'gh')
+        self.assertEqual(b'abcdEFgh', self._read_all())
+
+        other.seek(0)
+        other.write(b'XYZW12345')
+        writer.write(b'ij')
+        self.assertEqual(b'XYZW1234ij', self._read_all())
 
     def test_seek_write(self):
         writer = BlobWriter(self.db, self.directory, 4)
-        writer.write('abcdefgh')
+        writer.write(b'abcdefgh')
 
         writer.seek(5)
-        writer.write('12345')
+        writer.write(b'12345')
 
-        self.assertEquals('abcde12345', self._read_all())
+        self.assertEqual(b'abcde12345', self._read_all())
 
         # SEEK_CUR
         writer.seek(-1, 1)
         self.assertEqual(writer.tell(), 9)
 
+    def test_overwrite(self):
+        writer = BlobWriter(self.db, self.directory, 4)
+        writer.write(b'abcdefghijkl')
+
+        writer.seek(1)
+        writer.write(b'12')
+        self.assertEqual(b'a12defghijkl', self._read_all())
+
+        writer.seek(6)
+        writer.write(b'345')
+        self.assertEqual(b'a12def345jkl', self._read_all())
+        self.assertEqual(9, writer.tell())
+
     def test_seek_end(self):
         writer = BlobWriter(self.db, self.directory, 4)
-        writer.write('12345')
+        writer.write(b'12345')
         writer.seek(-1, 2)  # SEEK_END
 
         self.assertEqual(writer.tell(), 4)
-        writer.write('abcd')
+        writer.write(b'abcd')
         writer.close()
 
-        self.assertEquals('1234abcd', self._read_all())
+        self.assertEqual(b'1234abcd', self._read_all())
 
     def test_outbound_seek_write(self):
         writer = BlobWriter(self.db, self.directory, 4)
-        writer.write('abcdefgh')
-        self.assertEquals(8, writer.tell())
+        writer.write(b'abcdefgh')
+        self.assertEqual(8, writer.tell())
 
         # can't go out of blob size
         writer.seek(100)
-        self.assertEquals(8, writer.tell())
+        self.assertEqual(8, writer.tell())
 
     def test_seek_read(self):
         writer = BlobWriter(self.db, self.directory, 4)
-        writer.write('abcdefghijklmnop')
+        writer.write(b'abcdefghijklmnop')
 
         self.assertEqual(16, writer.tell())
 
         reader = BlobReader(self.db, self.directory, 4)
         reader.seek(4)
-        self.assertEquals('efghijklmnop', reader.read())
+        self.assertEqual(b'efghijklmnop', reader.read())
 
         reader.seek(2)
-        self.assertEquals('cdefghijklmnop', reader.read())
+        self.assertEqual(b'cdefghijklmnop', reader.read())
 
     def test_range_read(self):
         writer = BlobWriter(self.db, self.directory, 4)
-        writer.write('abcdefghijklmnop')
+        writer.write(b'abcdefghijklmnop')
 
         reader = BlobReader(self.db, self.directory, 4)
         reader.seek(2)
 
-        self.assertEquals(reader.read(4), 'cdef')
+        self.assertEqual(reader.read(4), b'cdef')
+        reader.seek(6)
+        self.assertEqual(reader.read(2), b'gh')
+
+    def test_cached_read(self):
+        writer = BlobWriter(self.db, self.directory, 4)
+        writer.write(b'abcdefghijklmn')
+
+        reader = BlobReader(self.db, self.directory, 4, cache_size=2)
+        reader.seek(2)
+        self.assertEqual(reader.read(8), b'cdefghij')
+        self.assertEqual(list(reader._cache), [1, 2])
+
         reader.seek(6)
-        self.assertEquals(reader.read(2), 'gh')
+        self.assertEqual(reader.read(), b'ghijklmn')
+        self.assertEqual(list(reader._cache), [1, 2])
+
+        # the short last chunk is not cached and an append drops the cache
+        writer.write(b'op')
+        reader.seek(4)
+        self.assertEqual(reader.read(), b'efghijklmnop')
+        self.assertEqual(list(reader._cache), [2, 3])
+
+        writer.write(b'qrst')
+        reader.seek(0)
+        self.assertEqual(reader.read(), b'abcdefghijklmnopqrst')
 
     def test_large_chunk(self):
         writer = BlobWriter(self.db, self.directory, 4)
 
         for i in range(513):
-            writer.write("1234")
+            writer.write(b"1234")
 
         reader = BlobReader(self.db, self.directory, 4)
         reader.seek(2040)
-        self.assertEqual(reader.read(), "123412341234")
+        self.assertEqual(reader.read(), b"123412341234")
+
+    def test_empty_read(self):
+        writer = BlobWriter(self.db, self.directory, 4)
+        writer.write(b'abcdefghij')
+
+        reader = BlobReader(self.db, self.directory, 4)
+        reader.seek(1)
+        self.assertEqual(reader.read(0), b'')
+        self.assertEqual(1, reader.tell())
+
+    def test_sparse_read(self):
+        manager = BlobManager(self.db, ('blob-test',), 4)
+        writer = manager.get_writer(b'test')
+        writer.write(b'abcdef')
+
+        # the writer goes on past the end of the deleted blob, the first chunk stays missing
+        manager.delete(b'test')
+        writer.write(b'gh')
+
+        self.assertEqual(manager.read(b'test'), b'\x00\x00\x00\x00\x00\x00gh')
+
+        with manager.get_reader(b'test') as reader:
+            reader.seek(2)
+            self.assertEqual(reader.read(3), b'\x00\x00\x00')
+            self.assertEqual(reader.read(), b'\x00gh')
+
+        # the blob was created again with the chunk size of the writer
+        other = BlobManager(self.db, ('blob-test',), 'latency')
+        self.assertEqual(other.read(b'test'), b'\x00\x00\x00\x00\x00\x00gh')
+
+    def test_large_range_read(self):
+        writer = BlobWriter(self.db, self.directory, 4)
+        writer.write(b'abcdefghijklmnop' * 10)
+
+        reader = BlobReader(self.db, self.directory, 4)
+        reader.seek(3)
+        self.assertEqual(reader.read(130), (b'abcdefghijklmnop' * 10)[3:133])
+        self.assertEqual(133, reader.tell())
+
+    def test_buffered_reader(self):
+        writer = BlobWriter(self.db, self.directory, 4)
+        self.assertEqual(16, writer.write(b'abcdefghijklmnop'))
+
+        reader = io.BufferedReader(BlobReader(self.db, self.directory, 4), buffer_size=8)
+        self.assertEqual(reader.read(3), b'abc')
+        self.assertEqual(reader.read(6), b'defghi')
+        self.assertEqual(reader.read(), b'jklmnop')
+
+        reader.seek(5)
+        buf = bytearray(4)
+        self.assertEqual(4, reader.readinto(buf))
+        self.assertEqual(buf, b'fghi')
 
     def test_closed_reader_writer(self):
         writer = BlobWriter(self.db, self.directory, 4)
-        writer.write('abcdefg')
+        writer.write(b'abcdefg')
         writer.close()
 
         self.assertTrue(writer.closed)
         with self.assertRaises(IOError):
-            writer.write('hij')
+            writer.write(b'hij')
 
         reader = BlobReader(self.db, self.directory, 4)
         reader.close()